@@ -4,27 +4,40 @@ GeoPlot Visualization Tool
 
 This tool generates an interactive 3D CesiumJS-based visualization from a simulation's state trajectory.
 It outputs:
-- An HTML file to render the plot.
-- A GeoJSON file representing the data over time.
+- An HTML file to render the plot, with the data embedded as CZML.
+- A gzip-compressed GeoJSON file representing the data over time.
 """
 
 # Import necessary libraries
-# re: Regular expressions for string operations
-# json: For handling JSON data
+# io: In-memory buffer for the gzipped CZML
+# os: For reading the GEOPLOT_DEBUG environment variable
+# ProcessPoolExecutor: For encoding entities in parallel
+# ExitStack, deque: For streaming encoded chunks into the outputs
+# gzip, base64: For compressing the GeoJSON and embedding it in the HTML
+# orjson: Fast JSON serialization with native NumPy support
 # pandas: For timestamp generation and manipulation
 # numpy: For numerical operations
 # Template: For substituting values in the HTML template
+# islice: For walking the rendered part of the state trajectory
 # get_by_path: Helper function to extract nested properties from a dictionary
-import re
-import json
+import io
+import os
+import gzip
+import base64
+import orjson
 import pandas as pd
 import numpy as np
 from string import Template
+from itertools import islice
+from collections import deque
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor
 from agent_torch.core.helpers import get_by_path
 
 # HTML template for Cesium visualization
 # This template defines the structure and behavior of the Cesium-based visualization.
-# It includes functions for interpolating colors, determining pixel sizes, and processing time-series data.
+# It loads the time-series data as CZML packets, whose sampled colors and pixel sizes
+# are precomputed in Python, through Cesium's native CZML parser.
 geoplot_template = """
 <!doctype html>
 <html lang="en">
@@ -43,118 +56,154 @@ geoplot_template = """
       Cesium.Ion.defaultAccessToken = '$accessToken';
       const viewer = new Cesium.Viewer('cesiumContainer');
 
-      // Interpolate between two colors based on a factor
-      function interpolateColor(color1, color2, factor) {
-        const result = new Cesium.Color();
-        result.red = color1.red + factor * (color2.red - color1.red);
-        result.green = color1.green + factor * (color2.green - color1.green);
-        result.blue = color1.blue + factor * (color2.blue - color1.blue);
-        result.alpha = '$visualType' == 'size' ? 0.2 : color1.alpha + factor * (color2.alpha - color1.alpha);
-        return result;
+      // Decode and decompress the embedded base64-encoded, gzipped CZML data
+      async function loadCzml(encoded) {
+        const bytes = Uint8Array.from(atob(encoded), (c) => c.charCodeAt(0));
+        const stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream('gzip'));
+        return JSON.parse(await new Response(stream).text());
       }
 
-      // Get color based on value (between blue and red)
-      function getColor(value, min, max) {
-        const factor = (value - min) / (max - min);
-        return interpolateColor(Cesium.Color.BLUE, Cesium.Color.RED, factor);
-      }
-
-      // Get pixel size based on value
-      function getPixelSize(value, min, max) {
-        const factor = (value - min) / (max - min);
-        return 100 * (1 + factor);
-      }
-
-      // Process GeoJSON data to build a time-series map
-      function processTimeSeriesData(geoJsonData) {
-        const timeSeriesMap = new Map();
-        let minValue = Infinity;
-        let maxValue = -Infinity;
-
-        geoJsonData.features.forEach((feature) => {
-          const id = feature.properties.id;
-          const time = Cesium.JulianDate.fromIso8601(feature.properties.time);
-          const value = feature.properties.value;
-          const coordinates = feature.geometry.coordinates;
-
-          if (!timeSeriesMap.has(id)) {
-            timeSeriesMap.set(id, []);
-          }
-          timeSeriesMap.get(id).push({ time, value, coordinates });
-
-          minValue = Math.min(minValue, value);
-          maxValue = Math.max(maxValue, value);
+      // Load all entities in one CZML data source; its document packet sets
+      // the viewer's clock and timeline
+      loadCzml('$data')
+        .then((czml) => Cesium.CzmlDataSource.load(czml))
+        .then((dataSource) => {
+          viewer.dataSources.add(dataSource);
+          viewer.zoomTo(dataSource);
         });
-
-        return { timeSeriesMap, minValue, maxValue };
-      }
-
-      // Create Cesium entities for the time series
-      function createTimeSeriesEntities(timeSeriesData, startTime, stopTime) {
-        const dataSource = new Cesium.CustomDataSource('AgentTorch Simulation');
-
-        for (const [id, timeSeries] of timeSeriesData.timeSeriesMap) {
-          const entity = new Cesium.Entity({
-            id: id,
-            availability: new Cesium.TimeIntervalCollection([
-              new Cesium.TimeInterval({ start: startTime, stop: stopTime }),
-            ]),
-            position: new Cesium.SampledPositionProperty(),
-            point: {
-              pixelSize: '$visualType' == 'size' ? new Cesium.SampledProperty(Number) : 10,
-              color: new Cesium.SampledProperty(Cesium.Color),
-            },
-            properties: {
-              value: new Cesium.SampledProperty(Number),
-            },
-          });
-
-          // Add each time sample
-          timeSeries.forEach(({ time, value, coordinates }) => {
-            const position = Cesium.Cartesian3.fromDegrees(coordinates[0], coordinates[1]);
-            entity.position.addSample(time, position);
-            entity.properties.value.addSample(time, value);
-            entity.point.color.addSample(time, getColor(value, timeSeriesData.minValue, timeSeriesData.maxValue));
-            if ('$visualType' == 'size') {
-              entity.point.pixelSize.addSample(time, getPixelSize(value, timeSeriesData.minValue, timeSeriesData.maxValue));
-            }
-          });
-
-          dataSource.entities.add(entity);
-        }
-
-        return dataSource;
-      }
-
-      // Load and visualize the time series data
-      const geoJsons = $data;
-      const start = Cesium.JulianDate.fromIso8601('$startTime');
-      const stop = Cesium.JulianDate.fromIso8601('$stopTime');
-
-      viewer.clock.startTime = start.clone();
-      viewer.clock.stopTime = stop.clone();
-      viewer.clock.currentTime = start.clone();
-      viewer.clock.clockRange = Cesium.ClockRange.LOOP_STOP;
-      viewer.clock.multiplier = 3600; // 1 hour per second
-
-      viewer.timeline.zoomTo(start, stop);
-
-      // Load all GeoJSON datasets
-      for (const geoJsonData of geoJsons) {
-        const timeSeriesData = processTimeSeriesData(geoJsonData);
-        const dataSource = createTimeSeriesEntities(timeSeriesData, start, stop);
-        viewer.dataSources.add(dataSource);
-        viewer.zoomTo(dataSource);
-      }
     </script>
   </body>
 </html>
 """
 
+# The template is split around the (potentially very large) data payload, so
+# the payload can be written to the HTML file without being copied into it
+geoplot_template_head, geoplot_template_tail = (
+    Template(part) for part in geoplot_template.split("$data")
+)
+
 # Helper function to extract nested property from the simulation state
 def read_var(state, var):
     """Helper to extract nested property from state based on path."""
-    return get_by_path(state, re.split("/", var))
+    return get_by_path(state, var.split("/"))
+
+# Helper function to encode the rows of a property column as JSON members
+def _encode_rows(name, array):
+    """Encode each row of a 1-D or 2-D array as a `"name":row` JSON member."""
+    if array.size == 0:
+        return []
+    # The whole column is encoded and keyed in bulk, then split into rows
+    key = b'"%s":' % name.encode()
+    encoded = orjson.dumps(array, option=orjson.OPT_SERIALIZE_NUMPY)
+    if array.ndim == 1:
+        return (key + encoded[1:-1].replace(b",", b"," + key)).split(b",")
+    return (
+        key + b"[" + encoded[2:-2].replace(b"],[", b"]\0" + key + b"[") + b"]"
+    ).split(b"\0")
+
+# Helper function to encode one entity's time series as GeoJSON
+def _encode_feature_collection(coord, properties, time_tails):
+    """Encode a FeatureCollection of Point features straight to JSON bytes."""
+    head = b'{"type":"Feature","geometry":%s,"properties":{' % orjson.dumps(
+        {"type": "Point", "coordinates": coord[[1, 0]]},
+        option=orjson.OPT_SERIALIZE_NUMPY,
+    )
+    columns = [_encode_rows(name, column) for name, column in properties.items()]
+    features = b",".join([
+        head + b",".join(row) + tail for *row, tail in zip(*columns, time_tails)
+    ])
+    return b'{"type":"FeatureCollection","features":[' + features + b"]}"
+
+# Helper function to encode a chunk of entities as GeoJSON FeatureCollections
+def _encode_feature_collections(coords, properties, keep, time_tails):
+    """Encode the kept samples of each entity, joined by commas."""
+    collections = []
+    for i, coord in enumerate(coords):
+        kept = np.flatnonzero(keep[i])
+        collections.append(_encode_feature_collection(
+            coord,
+            {name: column[i, kept] for name, column in properties.items()},
+            [time_tails[t] for t in kept],
+        ))
+    return b",".join(collections)
+
+# Helper function to interleave sample times with samples, as CZML expects
+def _interleave(seconds, samples, decimals):
+    """Flatten times and (rows of) samples into a [t0, s0..., t1, ...] array."""
+    samples = np.round(samples.astype(np.float64), decimals)
+    return np.column_stack((seconds, samples.reshape(len(seconds), -1))).ravel()
+
+# Helper function to encode a chunk of entities as CZML packets
+def _encode_czml_packets(
+    ids, coords, properties, keep, seconds, epoch, interval, precision
+):
+    """Encode the kept samples of each entity as CZML packets, joined by commas."""
+    packets = []
+    for i, (entity_id, coord) in enumerate(zip(ids, coords)):
+        kept = np.flatnonzero(keep[i])
+        if len(kept) == 0:
+            continue
+        times = seconds[kept]
+        point = {
+            "color": {
+                "epoch": epoch,
+                "rgba": _interleave(times, properties["rgba"][i, kept], 0),
+            },
+            "pixelSize": 10,
+        }
+        if "pixelSize" in properties:
+            point["pixelSize"] = {
+                "epoch": epoch,
+                "number": _interleave(times, properties["pixelSize"][i, kept], 1),
+            }
+        packets.append(orjson.dumps(
+            {
+                "id": str(entity_id),
+                "availability": interval,
+                "position": {
+                    "cartographicDegrees": np.array(
+                        [coord[1], coord[0], 0], dtype=coord.dtype
+                    ),
+                },
+                "point": point,
+                "properties": {
+                    "value": {
+                        "epoch": epoch,
+                        "number": _interleave(
+                            times, properties["value"][i, kept], precision
+                        ),
+                    },
+                },
+            },
+            option=orjson.OPT_SERIALIZE_NUMPY,
+        ))
+    return b",".join(packets)
+
+# Helper function to encode a chunk of entities, run in worker processes
+def _encode_chunk(
+    ids, coords, properties, keep, time_tails, seconds, epoch, interval, precision
+):
+    """Encode a chunk of entities as GeoJSON FeatureCollections and CZML packets."""
+    return (
+        _encode_feature_collections(coords, properties, keep, time_tails),
+        _encode_czml_packets(
+            ids, coords, properties, keep, seconds, epoch, interval, precision
+        ),
+    )
+
+# Helper function to lazily map a function over chunks in an executor
+def _map_bounded(executor, function, chunks, window):
+    """Yield function results in order, with at most window chunks in flight."""
+    pending = deque()
+    for chunk in chunks:
+        pending.append(executor.submit(function, *chunk))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+# Number of samples encoded per chunk, bounding the memory held by a chunk
+chunk_samples = 1 << 20
 
 # GeoPlot class for generating visualization outputs
 class GeoPlot:
@@ -174,66 +223,179 @@ class GeoPlot:
             options["feature"],
             options["visualization_type"],
         )
+        # Number of decimals values are rounded to in the output
+        self.precision = options.get("precision", 3)
+        # Number of processes used to encode the output (orjson holds the GIL)
+        self.workers = options.get("workers", 1)
+        # Pre-split the state paths, they are walked once per trajectory step
+        self._position_path = tuple(self.entity_position.split("/"))
+        self._property_path = tuple(self.entity_property.split("/"))
 
     def render(self, state_trajectory):
-        """Render the trajectory to GeoJSON and HTML visualization."""
-        coords, values = [], []
-        name = self.config["simulation_metadata"]["name"]
-        geodata_path, geoplot_path = f"{name}.geojson", f"{name}.html"
-
-        # Extract final state coordinates and properties
-        for i in range(0, len(state_trajectory) - 1):
-            final_state = state_trajectory[i][-1]
-            coords = np.array(read_var(final_state, self.entity_position)).tolist()
-            values.append(
-                np.array(read_var(final_state, self.entity_property)).flatten().tolist()
+        """Render the trajectory to GeoJSON and CZML-based HTML visualization."""
+        metadata = self.config["simulation_metadata"]
+        name = metadata["name"]
+        geodata_path, geoplot_path = f"{name}.geojson.gz", f"{name}.html"
+        num_steps = metadata["num_episodes"] * metadata["num_steps_per_episode"]
+
+        # The trajectory's last entry is not rendered, so at least two entries
+        # and one simulation step are needed
+        num_rows = min(len(state_trajectory) - 1, num_steps)
+        if num_rows < 1:
+            raise ValueError(
+                f"nothing to render: state_trajectory has {len(state_trajectory)} "
+                f"entries and the simulation has {num_steps} steps"
             )
 
+        # Entity positions are read once, from the last rendered state
+        final_state_last = state_trajectory[-2][-1]
+        coords = np.asarray(
+            get_by_path(final_state_last, self._position_path), dtype=np.float32
+        )
+
+        # Extract the property of interest from each final state into a
+        # preallocated (T, N) array; float32 matches Cesium's rendering
+        # precision and encodes to shorter literals. Like the positions above,
+        # the trajectory's last entry is not rendered
+        final_states = (steps[-1] for steps in islice(state_trajectory, num_rows))
+        first = np.asarray(
+            get_by_path(next(final_states), self._property_path)
+        ).ravel()
+        values_arr = np.empty((num_rows, first.size), dtype=np.float32)
+        values_arr[0] = first
+        for row, final_state in enumerate(final_states, start=1):
+            values_arr[row] = np.asarray(
+                get_by_path(final_state, self._property_path)
+            ).ravel()
+
         # Start time for the simulation
         start_time = pd.Timestamp.utcnow()
 
-        # Generate timestamps spaced by step_time
-        timestamps = [
-            start_time + pd.Timedelta(seconds=i * self.step_time)
-            for i in range(
-                self.config["simulation_metadata"]["num_episodes"] *
-                self.config["simulation_metadata"]["num_steps_per_episode"]
+        # Generate timestamps spaced by step_time, and format them once
+        timestamps = pd.date_range(
+            start=start_time,
+            periods=num_steps,
+            freq=pd.Timedelta(seconds=self.step_time),
+        )
+        iso_times = timestamps.strftime("%Y-%m-%dT%H:%M:%S.%fZ").to_numpy()
+        seconds = (timestamps - timestamps[0]).total_seconds().to_numpy()
+        interval = f"{iso_times[0]}/{iso_times[-1]}"
+
+        # Lay each entity's time series out contiguously, shape (N, T), rounded
+        # to the output precision
+        values_by_coord = np.round(np.ascontiguousarray(values_arr.T), self.precision)
+
+        # Only keep samples at which the value starts or stops changing, since
+        # Cesium interpolates the ones in between, and drop NaN samples
+        changed = values_by_coord[:, 1:] != values_by_coord[:, :-1]
+        keep = np.ones(values_by_coord.shape, dtype=bool)
+        keep[:, 1:-1] = changed[:, :-1] | changed[:, 1:]
+        keep &= ~np.isnan(values_by_coord)
+
+        # Precompute each sample's color (blue to red) and pixel size from where
+        # its value lies within the entity's range, instead of in the browser
+        value_min = np.min(
+            values_by_coord, axis=1, where=keep, initial=np.inf, keepdims=True
+        )
+        value_max = np.max(
+            values_by_coord, axis=1, where=keep, initial=-np.inf, keepdims=True
+        )
+        value_range = value_max - value_min
+        factor = np.divide(
+            values_by_coord - value_min,
+            value_range,
+            out=np.zeros_like(values_by_coord),
+            where=keep & (value_range > 0),
+        )
+        rgba = np.empty(factor.shape + (4,), dtype=np.uint8)
+        rgba[..., 0] = np.round(255 * factor)
+        rgba[..., 1] = 0
+        rgba[..., 2] = 255 - rgba[..., 0]
+        rgba[..., 3] = 51 if self.visualization_type == "size" else 255
+        properties = {"value": values_by_coord, "rgba": rgba}
+        if self.visualization_type == "size":
+            properties["pixelSize"] = np.round(100 * (1 + factor), 1)
+
+        # Every feature of a given timestep ends with the same bytes
+        time_tails = [b',"time":"%s"}}' % time.encode() for time in iso_times]
+
+        # Encode the GeoJSON FeatureCollections for the GeoJSON file and the
+        # CZML packets for the HTML in chunks of entities of bounded size, and
+        # stream each chunk into both gzipped outputs as soon as it is ready;
+        # level 1 is nearly as fast as a copy and still shrinks the repetitive
+        # keys and timestamps several times over
+        chunk_size = max(1, min(
+            -(-len(coords) // self.workers), chunk_samples // num_steps
+        ))
+        entity_ids = range(len(coords))
+        chunks = (
+            (
+                entity_ids[lo:lo + chunk_size],
+                coords[lo:lo + chunk_size],
+                {
+                    name: column[lo:lo + chunk_size]
+                    for name, column in properties.items()
+                },
+                keep[lo:lo + chunk_size],
+                time_tails,
+                seconds,
+                iso_times[0],
+                interval,
+                self.precision,
             )
-        ]
-
-        geojsons = []
-
-        # Construct GeoJSON features for visualization
-        for i, coord in enumerate(coords):
-            features = []
-            for time, value_list in zip(timestamps, values):
-                features.append({
-                    "type": "Feature",
-                    "geometry": {
-                        "type": "Point",
-                        "coordinates": [coord[1], coord[0]],
-                    },
-                    "properties": {
-                        "value": value_list[i],
-                        "time": time.isoformat(),
-                    },
-                })
-            geojsons.append({"type": "FeatureCollection", "features": features})
-
-        # Write GeoJSON output file
-        with open(geodata_path, "w", encoding="utf-8") as f:
-            json.dump(geojsons, f, ensure_ascii=False, indent=2)
-
-        # Generate HTML file by substituting template values
-        tmpl = Template(geoplot_template)
-        with open(geoplot_path, "w", encoding="utf-8") as f:
-            f.write(
-                tmpl.substitute({
-                    "accessToken": self.cesium_token,
-                    "startTime": timestamps[0].isoformat(),
-                    "stopTime": timestamps[-1].isoformat(),
-                    "data": json.dumps(geojsons),
-                    "visualType": self.visualization_type,
-                })
+            for lo in range(0, len(coords), chunk_size)
+        )
+        debug = os.environ.get("GEOPLOT_DEBUG")
+        czml_buffer = io.BytesIO()
+        with ExitStack() as stack:
+            geodata = stack.enter_context(
+                gzip.open(geodata_path, "wb", compresslevel=1)
+            )
+            czml = stack.enter_context(
+                gzip.GzipFile(fileobj=czml_buffer, mode="wb", compresslevel=1)
             )
+            if self.workers > 1:
+                executor = stack.enter_context(
+                    ProcessPoolExecutor(max_workers=self.workers)
+                )
+                encoded = _map_bounded(
+                    executor, _encode_chunk, chunks, 2 * self.workers
+                )
+            else:
+                encoded = (_encode_chunk(*chunk) for chunk in chunks)
+
+            geodata.write(b"[")
+            czml.write(b"[" + orjson.dumps({
+                "id": "document",
+                "name": "AgentTorch Simulation",
+                "version": "1.0",
+                "clock": {
+                    "interval": interval,
+                    "currentTime": iso_times[0],
+                    "multiplier": 3600,  # 1 hour per second
+                    "range": "LOOP_STOP",
+                },
+            }))
+            for i, (collections, packets) in enumerate(encoded):
+                # The GeoJSON file is written compactly, unless GEOPLOT_DEBUG
+                # is set to get an indented copy for inspection
+                if debug:
+                    collections = b",\n".join([
+                        orjson.dumps(collection, option=orjson.OPT_INDENT_2)
+                        for collection in orjson.loads(b"[%s]" % collections)
+                    ])
+                if i > 0:
+                    geodata.write(b",")
+                geodata.write(collections)
+                if packets:
+                    czml.write(b",")
+                    czml.write(packets)
+            geodata.write(b"]")
+            czml.write(b"]")
 
+        # Generate HTML file by substituting template values around the data
+        substitutions = {"accessToken": self.cesium_token}
+        with open(geoplot_path, "wb") as f:
+            f.write(geoplot_template_head.substitute(substitutions).encode("utf-8"))
+            f.write(base64.b64encode(czml_buffer.getbuffer()))
+            f.write(geoplot_template_tail.substitute(substitutions).encode("utf-8"))